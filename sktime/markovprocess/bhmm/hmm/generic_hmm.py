@@ -518,12 +518,10 @@ class HMM(Model):
         >>> O, S = model.generate_synthetic_observation_trajectories(ntrajectories=10, length=100, initial_Pi=np.array([1,0,0]))
 
         """
-        O = []  # observations
-        S = []  # state trajectories
-        for trajectory_index in range(ntrajectories):
-            o_t, s_t = self.generate_synthetic_observation_trajectory(length=length, initial_Pi=initial_Pi)
-            O.append(o_t)
-            S.append(s_t)
+        # state trajectories
+        S = [self.generate_synthetic_state_trajectory(length, initial_Pi=initial_Pi) for _ in range(ntrajectories)]
+        # observations, generated for all state trajectories at once
+        O = self.output_model.generate_observation_trajectories(S)
 
         return O, S
 
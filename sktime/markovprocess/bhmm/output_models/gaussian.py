@@ -16,17 +16,52 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import copy
+
 import numpy as np
 
 from sktime.markovprocess.bhmm.output_models.outputmodel import OutputModel
 from ._bhmm_output_models import gaussian as gaussian
 
+# log_p_obs is evaluated in tiles of (T_block, N) elements of at most this many bytes, so that the working set of a tile
+# stays cache resident
+_P_OBS_BLOCK_BYTES = 128 * 1024
+
+# fit() concatenates consecutive trajectories into chunks of at most this many time steps
+_FIT_CHUNK_LENGTH = 65536
+
+
+def _pack(observations):
+    r""" Packs a ragged list of 1D arrays into one flat array and the offsets of the arrays within it, such that
+    observations[k] is flat[offsets[k]:offsets[k + 1]]. """
+    offsets = np.zeros(len(observations) + 1, dtype=int)
+    np.cumsum([len(o) for o in observations], out=offsets[1:])
+    flat = np.concatenate(observations) if len(observations) > 0 else np.empty(0)
+    return flat, offsets
+
+
+def _chunks(offsets, chunk_length):
+    r""" Groups consecutive trajectories with the given offsets into ranges [k0, k1) of at most chunk_length time
+    steps in total. A trajectory of at least chunk_length time steps forms a range of its own. """
+    k0 = 0
+    for k in range(len(offsets) - 1):
+        if k > k0 and offsets[k + 1] - offsets[k0] > chunk_length:
+            yield k0, k
+            k0 = k
+    if k0 < len(offsets) - 1:
+        yield k0, len(offsets) - 1
+
+
+def _block_length(n_states, itemsize):
+    r""" Number of time steps per tile of log_p_obs """
+    return max(1, _P_OBS_BLOCK_BYTES // (n_states * itemsize))
 
 
 class GaussianOutputModel(OutputModel):
     """ HMM output probability model using 1D-Gaussians """
 
-    def __init__(self, n_states, means=None, sigmas=None, ignore_outliers=True):
+    def __init__(self, n_states, means=None, sigmas=None, ignore_outliers=True, seed=None, dtype=np.float64,
+                 cache_p_obs=False):
         """
         Create a 1D Gaussian output model.
 
@@ -38,6 +73,20 @@ class GaussianOutputModel(OutputModel):
             If specified, initialize the Gaussian means to these values.
         sigmas : array_like of shape (n_states,), optional, default=None
             If specified, initialize the Gaussian variances to these values.
+        seed : int, numpy.random.Generator or None, optional, default=None
+            Seed of the random number generator used for sampling parameters and generating synthetic observations,
+            or the generator itself. If None, the global numpy random state is used, so that np.random.seed makes
+            the results reproducible.
+        dtype : numpy.dtype, optional, default=np.float64
+            Floating point type in which the parameters are stored, output probabilities are computed and synthetic
+            observations are generated. np.float32 halves the memory traffic of p_obs for long trajectories, but
+            densities underflow much earlier and the round-off floor of the fitted variances is coarser.
+            If p_obs is called with an output array, the computation happens in the dtype of that array.
+        cache_p_obs : bool, optional, default=False
+            If True, p_obs called without an output array writes into an internal (T, N) buffer, which is reused by
+            subsequent calls on trajectories of the same length instead of allocating a new array each time. The
+            returned array is then overwritten by the next call and has to be copied if it is to be kept.
+            The buffer can be released with reset_buffers().
 
         Examples
         --------
@@ -49,27 +98,62 @@ class GaussianOutputModel(OutputModel):
         """
         super(GaussianOutputModel, self).__init__(n_states=n_states, ignore_outliers=ignore_outliers)
 
-        dtype = np.float64  # type for internal storage
+        self._rng = np.random.default_rng(seed) if seed is not None else None
+        self._cache_p_obs = cache_p_obs
+        self._p_obs_buffer = None
+
+        # state-wise parameters packed into one contiguous block, each row holding
+        # [mean, sigma, 1 / (2 sigma^2), -log(sqrt(2 pi) sigma)] of one state
+        self._params = np.zeros((n_states, 4), dtype=dtype)
 
         if means is not None:
-            self._means = np.array(means, dtype=dtype)
-            if self._means.shape != (n_states,):
-                raise ValueError('means must have shape (%d,); instead got %s' % (n_states, str(self._means.shape)))
-        else:
-            self._means = np.zeros(n_states, dtype=dtype)
+            means = np.asarray(means, dtype=dtype)
+            if means.shape != (n_states,):
+                raise ValueError('means must have shape (%d,); instead got %s' % (n_states, str(means.shape)))
+            self.means = means
 
         if sigmas is not None:
-            self._sigmas = np.array(sigmas, dtype=dtype).squeeze()
-            if self._sigmas.shape != (n_states,):
-                raise ValueError('sigmas must have shape (%d,); instead got %s' % (n_states, str(self._sigmas.shape)))
+            sigmas = np.asarray(sigmas, dtype=dtype).squeeze()
+            if sigmas.shape != (n_states,):
+                raise ValueError('sigmas must have shape (%d,); instead got %s' % (n_states, str(sigmas.shape)))
         else:
-            self._sigmas = np.zeros(n_states, dtype=dtype)
+            sigmas = np.zeros(n_states, dtype=dtype)
+        self.sigmas = sigmas
+
+    def __deepcopy__(self, memo):
+        # A copied generator would replay the random numbers of the original. Instead, seed the generator of the copy
+        # from the original one, which also advances it, so that subsequent copies draw different numbers.
+        # The p_obs buffer is scratch space and is not copied; the copy allocates its own on first use.
+        result = self.__class__.__new__(self.__class__)
+        memo[id(self)] = result
+        state = {k: v for k, v in self.__dict__.items() if k not in ('_rng', '_p_obs_buffer')}
+        result.__dict__.update(copy.deepcopy(state, memo))
+        result._p_obs_buffer = None
+        seed = self._derived_seed()
+        result._rng = np.random.default_rng(seed) if seed is not None else None
+        return result
+
+    def _derived_seed(self):
+        r""" Draws a seed for the generator of a copy or sub-model from the generator of this model, None if this
+        model is not seeded """
+        return None if self._rng is None else self._rng.integers(np.iinfo(np.int64).max)
+
+    @property
+    def _random(self):
+        r""" Source of random numbers: the generator of the model if it was seeded, otherwise the global numpy
+        random state """
+        return np.random if self._rng is None else self._rng
 
     @property
     def model_type(self):
         r""" Model type. Returns 'gaussian' """
         return 'gaussian'
 
+    @property
+    def dtype(self):
+        r""" Floating point type of the parameters and output probabilities """
+        return self._params.dtype
+
     @property
     def dimension(self):
         r""" Dimension of the Gaussian output model (currently 1) """
@@ -78,17 +162,41 @@ class GaussianOutputModel(OutputModel):
     @property
     def means(self):
         r""" Mean values of Gaussians output densities """
-        return self._means
+        return self._params[:, 0]
+
+    @means.setter
+    def means(self, value):
+        self._params[:, 0] = value
 
     @property
     def sigmas(self):
         # TODO: Should we not rather give the variances? In the multidimensional case on usually uses the covariance
         # TODO:   matrix instead of its square root.
-        r""" Standard deviations of Gaussian output densities """
-        return self._sigmas
+        r""" Standard deviations of Gaussian output densities. The returned view is read-only, as changing sigmas
+        requires updating the cached constants of the densities; assign to the property instead. """
+        sigmas = self._params[:, 1]
+        sigmas.flags.writeable = False
+        return sigmas
+
+    @sigmas.setter
+    def sigmas(self, value):
+        self._params[:, 1] = value
+        self._precompute()
+
+    def _precompute(self):
+        r""" Caches the state-wise constants of the Gaussian log-densities, which only depend on the sigmas:
+        1 / (2 sigma^2) and the log-normalization -log(sqrt(2 pi) sigma). Has to be invoked whenever the sigmas
+        are changed. """
+        sigmas = self._params[:, 1]
+        with np.errstate(divide='ignore'):
+            self._params[:, 2] = 0.5 / sigmas ** 2
+            self._params[:, 3] = -0.5 * np.log(2 * np.pi) - np.log(sigmas)
 
     def sub_output_model(self, states):
-        return GaussianOutputModel(self._means[states], self._sigmas[states])
+        means, sigmas = self.means[states], self.sigmas[states]
+        return GaussianOutputModel(n_states=len(means), means=means, sigmas=sigmas,
+                                   ignore_outliers=self.ignore_outliers, seed=self._derived_seed(), dtype=self.dtype,
+                                   cache_p_obs=self._cache_p_obs)
 
     def p_obs(self, obs, out=None):
         """
@@ -98,6 +206,9 @@ class GaussianOutputModel(OutputModel):
         ----------
         oobs : ndarray((T), dtype=int)
             a discrete trajectory of length T
+        out : ndarray((T', N), dtype=float), optional, default=None
+            output array with T' >= T, the first T rows are written. If given, the probabilities are computed in its
+            dtype, otherwise in the dtype of the model.
 
         Return
         ------
@@ -119,9 +230,78 @@ class GaussianOutputModel(OutputModel):
         >>> p_o = output_model.p_obs(o_t)
 
         """
-        res = gaussian.p_obs(obs, self.means, self.sigmas, out=out)
+        if out is None and self._cache_p_obs:
+            out = self._get_p_obs_buffer(len(obs))
+        obs, params = self._cast(obs, out)
+        res = gaussian.p_obs(obs, params, out=out)
         return self._handle_outliers(res)
 
+    def _get_p_obs_buffer(self, T):
+        r""" Returns the cached (T, N) output buffer of p_obs, reallocating it if shape or dtype changed. """
+        buffer = self._p_obs_buffer
+        if buffer is None or buffer.shape != (T, self.n_states) or buffer.dtype != self.dtype:
+            buffer = self._p_obs_buffer = np.empty((T, self.n_states), dtype=self.dtype)
+        return buffer
+
+    def reset_buffers(self):
+        r""" Releases the cached output buffer of p_obs, see the cache_p_obs argument of the constructor. """
+        self._p_obs_buffer = None
+
+    def _cast(self, obs, out):
+        r""" Casts the observations and the packed parameters to the dtype of out if given, otherwise to the dtype
+        of the model, so that the kernels operate on a single dtype. """
+        dtype = self.dtype if out is None else out.dtype
+        params = self._params if dtype == self.dtype else self._params.astype(dtype)
+        return np.asarray(obs, dtype=dtype), params
+
+    @staticmethod
+    def _log_p_obs_block(obs, params, out):
+        r""" Evaluates the log-densities of a tile of observations in-place on out, which has shape (len(obs), N). """
+        mu, inv_2s2, log_norm = params[:, 0], params[:, 2], params[:, 3]
+        np.subtract(obs[:, None], mu[None, :], out=out)
+        np.square(out, out=out)
+        out *= -inv_2s2
+        out += log_norm
+        return out
+
+    def log_p_obs(self, obs, out=None):
+        """
+        Returns the logarithm of the output probabilities for an entire trajectory and all hidden states
+
+        The log-densities are computed directly from the cached constants, so that they stay finite for observations
+        far away from all means, where p_obs underflows to zero.
+
+        Parameters
+        ----------
+        obs : ndarray((T), dtype=float)
+            a trajectory of length T
+        out : ndarray((T', N), dtype=float), optional, default=None
+            output array with T' >= T, the first T rows are written. If given, the log-probabilities are computed in
+            its dtype, otherwise in the dtype of the model.
+
+        Return
+        ------
+        log_p_o : ndarray (T,N)
+            the log probability of generating the observation at time point t from any of the N hidden states
+
+        Examples
+        --------
+
+        >>> output_model = GaussianOutputModel(n_states=2, means=[-1, +1], sigmas=[0.1, 0.1])
+        >>> log_p_o = output_model.log_p_obs(np.array([-100., 0., 100.]))
+
+        """
+        obs, params = self._cast(obs, out)
+        T = obs.shape[0]
+        if out is None:
+            out = np.empty((T, self.n_states), dtype=params.dtype)
+        # out may have more rows than obs, only the first T are written
+        log_p_o = out[:T]
+        block_length = _block_length(self.n_states, out.itemsize)
+        for t0 in range(0, T, block_length):
+            self._log_p_obs_block(obs[t0:t0 + block_length], params, log_p_o[t0:t0 + block_length])
+        return out
+
     def fit(self, observations, weights):
         """
         Fits the output model given the observations and weights
@@ -153,34 +333,35 @@ class GaussianOutputModel(OutputModel):
         # sizes
         N = self.n_states
         K = len(observations)
-
-        # fit means
-        self._means = np.zeros(N)
-        w_sum = np.zeros(N)
-        for k in range(K):
-            # update nominator
-            for i in range(N):
-                self.means[i] += np.dot(weights[k][:, i], observations[k])
-            # update denominator
-            w_sum += np.sum(weights[k], axis=0)
-        # normalize
-        self._means /= w_sum
-
-        # fit variances
-        self._sigmas = np.zeros(N)
-        w_sum = np.zeros(N)
-        for k in range(K):
-            # update nominator
-            for i in range(N):
-                Y = (observations[k] - self.means[i]) ** 2
-                self.sigmas[i] += np.dot(weights[k][:, i], Y)
-            # update denominator
-            w_sum += np.sum(weights[k], axis=0)
-        # normalize
-        self._sigmas /= w_sum
-        self._sigmas = np.sqrt(self.sigmas)
-        if np.any(self._sigmas < np.finfo(self._sigmas.dtype).eps):
-            raise RuntimeError('at least one sigma is too small to continue.')
+        if K == 0:
+            return
+
+        # accumulate weighted zeroth, first and second moments in a single pass over the weights. Stacking
+        # [1, x, x^2] lets one product with the transposed weights yield all three, reading the weights only once.
+        # Short trajectories are grouped into chunks, so that each chunk is handled by a single product while the
+        # copies of the weights stay bounded in size; the weights of long trajectories are used in place. The
+        # observations are copied into one packed array, and each chunk builds a (T, 3) temporary. The moments
+        # are taken about a common shift, the mean of all observations, which reduces the cancellation in
+        # E[x^2] - E[x]^2 when all states share an offset that is large relative to their spread. States whose means
+        # lie far from the shift relative to their own sigma still cancel.
+        X, offsets = _pack(observations)
+        shift = np.mean(X)
+        moments = np.zeros((N, 3))
+        for k0, k1 in _chunks(offsets, _FIT_CHUNK_LENGTH):
+            x = X[offsets[k0]:offsets[k1]] - shift
+            W = weights[k0] if k1 - k0 == 1 else np.concatenate(weights[k0:k1], axis=0)
+            moments += W.T @ np.column_stack((np.ones_like(x), x, x * x))
+        w_sum, m1, m2 = moments.T
+
+        # fit means and variances, using Var[x] = E[x^2] - E[x]^2. The difference is only accurate up to about
+        # eps * E[x^2], so variances below that level are round-off and are clamped to it instead of producing zero
+        # or negative variances. The floor scales with the data, and the smallest normal number guards against data
+        # that coincide with the shift exactly.
+        finfo = np.finfo(self.dtype)
+        m1 /= w_sum
+        m2 /= w_sum
+        self.means = m1 + shift
+        self.sigmas = np.sqrt(np.maximum(m2 - m1 ** 2, np.maximum(finfo.eps * m2, finfo.tiny)))
 
     def sample(self, observations, prior=None):
         """
@@ -210,25 +391,31 @@ class GaussianOutputModel(OutputModel):
         >>> output_model.sample(observations)
 
         """
-        for state_index in range(self.n_states):
-            # Update state emission distribution parameters.
-
-            observations_in_state = observations[state_index]
-            # Determine number of samples in this state.
-            nsamples_in_state = len(observations_in_state)
-
-            # Skip update if no observations.
-            if nsamples_in_state == 0:
-                import warnings
-                warnings.warn('Warning: State %d has no observations.' % state_index)
-            if nsamples_in_state > 0:  # Sample new mu.
-                self.means[state_index] = np.random.randn() * self.sigmas[state_index] / np.sqrt(
-                    nsamples_in_state) + np.mean(observations_in_state)
-            if nsamples_in_state > 1:  # Sample new sigma
-                # This scheme uses the improper Jeffreys prior on sigma^2, P(mu, sigma^2) \propto 1/sigma
-                chisquared = np.random.chisquare(nsamples_in_state - 1)
-                sigmahat2 = np.mean((observations_in_state - self.means[state_index]) ** 2)
-                self.sigmas[state_index] = np.sqrt(sigmahat2) / np.sqrt(chisquared / nsamples_in_state)
+        # Determine number of samples in each state.
+        X, offsets = _pack(observations)
+        nsamples = np.diff(offsets)
+        labels = np.repeat(np.arange(self.n_states), nsamples)
+        # Skip update if no observations.
+        for state_index in np.flatnonzero(nsamples == 0):
+            import warnings
+            warnings.warn('Warning: State %d has no observations.' % state_index)
+        has_mean, has_sigma = nsamples > 0, nsamples > 1
+        n = np.maximum(nsamples, 1)
+
+        # Draw the random numbers for all states at once.
+        z = self._random.standard_normal(self.n_states)
+        chisquared = self._random.chisquare(np.maximum(nsamples - 1, 1))
+
+        # Sample new mu.
+        mean_obs = np.bincount(labels, weights=X, minlength=self.n_states) / n
+        means = np.where(has_mean, z * self.sigmas / np.sqrt(n) + mean_obs, self.means)
+        # Sample new sigma.
+        # This scheme uses the improper Jeffreys prior on sigma^2, P(mu, sigma^2) \propto 1/sigma
+        sigmahat2 = np.bincount(labels, weights=(X - means[labels]) ** 2, minlength=self.n_states) / n
+        sigmas = np.where(has_sigma, np.sqrt(sigmahat2) / np.sqrt(chisquared / n), self.sigmas)
+
+        self.means = means
+        self.sigmas = sigmas
 
     def generate_observation_from_state(self, state_index):
         """
@@ -256,7 +443,7 @@ class GaussianOutputModel(OutputModel):
         >>> observation = output_model.generate_observation_from_state(0)
 
         """
-        observation = self.sigmas[state_index] * np.random.randn() + self.means[state_index]
+        observation = self.sigmas[state_index] * self._random.standard_normal() + self.means[state_index]
         return observation
 
     def generate_observations_from_state(self, state_index, nobs):
@@ -287,7 +474,8 @@ class GaussianOutputModel(OutputModel):
         >>> observations = [output_model.generate_observations_from_state(state_index, nobs=100) for state_index in range(output_model.n_states) ]
 
         """
-        observations = self.sigmas[state_index] * np.random.randn(nobs) + self.means[state_index]
+        normal = self._random.standard_normal(nobs).astype(self.dtype, copy=False)
+        observations = self.sigmas[state_index] * normal + self.means[state_index]
         return observations
 
     def generate_observation_trajectory(self, s_t):
@@ -322,8 +510,41 @@ class GaussianOutputModel(OutputModel):
         # Determine number of samples to generate.
         T = s_t.shape[0]
 
-        o_t = np.zeros([T], dtype=np.float64)
-        for t in range(T):
-            s = s_t[t]
-            o_t[t] = self.sigmas[s] * np.random.randn() + self.means[s]
+        normal = self._random.standard_normal(T).astype(self.dtype, copy=False)
+        o_t = self.sigmas[s_t] * normal + self.means[s_t]
         return o_t
+
+    def generate_observation_trajectories(self, s_ts):
+        """
+        Generate synthetic observation data from a number of given state sequences.
+
+        The observations of all trajectories are generated at once on the concatenated state sequences.
+
+        Parameters
+        ----------
+        s_ts : list of numpy.array with shape (T_k,) of int type
+            s_ts[k][t] is the hidden state sampled at time t in trajectory k
+
+        Returns
+        -------
+        o_ts : list of numpy.array with shape (T_k,) of type dtype
+            o_ts[k][t] is the observation associated with state s_ts[k][t]
+
+        Examples
+        --------
+
+        Generate an observation model and synthetic state trajectories.
+
+        >>> output_model = GaussianOutputModel(n_states=3, means=[-1, 0, +1], sigmas=[0.5, 1, 2])
+        >>> s_ts = [np.random.randint(0, output_model.n_states, size=[nobs]) for nobs in (100, 1000)]
+
+        Generate synthetic trajectories
+
+        >>> o_ts = output_model.generate_observation_trajectories(s_ts)
+
+        """
+        if len(s_ts) == 0:
+            return []
+        lengths = [s_t.shape[0] for s_t in s_ts]
+        o_t = self.generate_observation_trajectory(np.concatenate(s_ts))
+        return np.split(o_t, np.cumsum(lengths)[:-1])
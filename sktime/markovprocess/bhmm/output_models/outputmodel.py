@@ -93,9 +93,10 @@ class OutputModel(object, metaclass=ABCMeta):
             output probabilities
         """
         if self.ignore_outliers:
-            outliers = np.where(p_o.sum(axis=1) == 0)[0]
-            if outliers.size > 0:
-                p_o[outliers, :] = 1.0
+            # output probabilities are non-negative, so a row sums to zero iff it has no nonzero entry
+            outliers = ~np.any(p_o, axis=1)
+            if np.any(outliers):
+                p_o[outliers] = 1.0
                 self.found_outliers = True
         return p_o
 
@@ -115,3 +116,22 @@ class OutputModel(object, metaclass=ABCMeta):
             o_t[t] is the observation associated with state s_t[t]
         """
         pass
+
+    def generate_observation_trajectories(self, s_ts):
+        """
+        Generate synthetic observation data from a number of given state sequences.
+
+        This is a default implementation that generates the trajectories one by one. Output models which can generate
+        observations for many state sequences at once should override it.
+
+        Parameters
+        ----------
+        s_ts : list of numpy.array with shape (T_k,) of int type
+            s_ts[k][t] is the hidden state sampled at time t in trajectory k
+
+        Returns
+        -------
+        o_ts : list of numpy.array with shape (T_k,) of type dtype
+            o_ts[k][t] is the observation associated with state s_ts[k][t]
+        """
+        return [self.generate_observation_trajectory(s_t) for s_t in s_ts]
@@ -6,6 +6,7 @@
  */
 
 #include <tuple>
+#include <cmath>
 #include <pybind11/pybind11.h>
 #include <pybind11/numpy.h>
 
@@ -17,26 +18,31 @@ using np_array = py::array_t<dtype, py::array::c_style>;
 
 namespace gaussian {
 
-template<typename dtype>
-constexpr dtype pi() { return 3.141592653589793238462643383279502884e+00; }
+/**
+ * Layout of the state-wise parameters: one row per state, holding
+ * [mean, sigma, 1 / (2 sigma^2), -log(sqrt(2 pi) sigma)]. The last two columns are precomputed on the python side
+ * whenever sigma changes, so that evaluating a density only requires a multiply-add and an exp.
+ */
+constexpr std::size_t PARAMS_MU = 0;
+constexpr std::size_t PARAMS_INV_2_SIGMA2 = 2;
+constexpr std::size_t PARAMS_LOG_NORM = 3;
+constexpr std::size_t N_PARAMS = 4;
 
 /**
- * Returns the probability density of a Gaussian with given mu and sigma evaluated at o
+ * Returns the probability density of a Gaussian evaluated at o
  * @tparam dtype data type
  * @param o observation value
- * @param mu mean value
- * @param sigma standard deviation
+ * @param params parameters of the Gaussian, see above
  */
 template<typename dtype>
-constexpr dtype sample(dtype o, dtype mu, dtype sigma) {
-    double c = 1.0 / (std::sqrt(2.0 * pi<dtype>()) * sigma);
-    double d = (o - mu) / sigma;
-    return c * exp(-0.5 * d * d);
+dtype sample(dtype o, const dtype* params) {
+    dtype d = o - params[PARAMS_MU];
+    return std::exp(params[PARAMS_LOG_NORM] - d * d * params[PARAMS_INV_2_SIGMA2]);
 }
 
 template<typename dtype>
-np_array<dtype> pO(dtype o, const np_array<dtype> &mus, const np_array<dtype> &sigmas, py::object out) {
-    auto N = static_cast<std::size_t>(mus.shape(0));
+np_array<dtype> pO(dtype o, const np_array<dtype> &params, py::object out) {
+    auto N = static_cast<std::size_t>(params.shape(0));
 
     np_array<dtype> p;
     if(!out.is_none()) {
@@ -45,20 +51,19 @@ np_array<dtype> pO(dtype o, const np_array<dtype> &mus, const np_array<dtype> &s
         p = np_array<dtype>({N});
     }
     auto pBuf = p.mutable_data();
-    auto musBuf = mus.data();
-    auto sigmasBuf = sigmas.data();
+    auto paramsBuf = params.data();
 
     #pragma omp parallel for
     for(std::size_t i = 0; i < N; ++i) {
-        pBuf[i] = sample(o, musBuf[i], sigmasBuf[i]);
+        pBuf[i] = sample(o, paramsBuf + i * N_PARAMS);
     }
 
     return p;
 }
 
 template<typename dtype>
-np_array<dtype> pObs(const np_array<dtype> &obs, const np_array<dtype> &mus, const np_array<dtype> &sigmas, py::object out) {
-    auto N = static_cast<std::size_t>(mus.shape(0));
+np_array<dtype> pObs(const np_array<dtype> &obs, const np_array<dtype> &params, py::object out) {
+    auto N = static_cast<std::size_t>(params.shape(0));
     auto T = static_cast<std::size_t>(obs.shape(0));
 
     np_array<dtype> p;
@@ -68,14 +73,13 @@ np_array<dtype> pObs(const np_array<dtype> &obs, const np_array<dtype> &mus, con
         p = np_array<dtype>({T, N});
     }
     auto obsBuf = obs.data();
-    auto musBuf = mus.data();
-    auto sigmasBuf = sigmas.data();
+    auto paramsBuf = params.data();
     auto pBuf = p.mutable_data();
 
     #pragma omp parallel for collapse(2)
     for (std::size_t t=0; t<T; ++t) {
         for (std::size_t i = 0; i < N; ++i) {
-            pBuf[t * N + i] = sample(obsBuf[t], musBuf[i], sigmasBuf[i]);
+            pBuf[t * N + i] = sample(obsBuf[t], paramsBuf + i * N_PARAMS);
         }
     }
 
@@ -118,9 +122,9 @@ PYBIND11_MODULE(_bhmm_output_models, m) {
 
     {
         auto gaussian = m.def_submodule("gaussian");
-        gaussian.def("p_o", &gaussian::pO<double>, "o"_a, "mus"_a, "sigmas"_a, "out"_a = py::none());
-        gaussian.def("p_o", &gaussian::pO<float>, "o"_a, "mus"_a, "sigmas"_a, "out"_a = py::none());
-        gaussian.def("p_obs", &gaussian::pObs<double>, "obs"_a, "mus"_a, "sigmas"_a, "out"_a = py::none());
-        gaussian.def("p_obs", &gaussian::pObs<float>, "obs"_a, "mus"_a, "sigmas"_a, "out"_a = py::none());
+        gaussian.def("p_o", &gaussian::pO<double>, "o"_a, "params"_a, "out"_a = py::none());
+        gaussian.def("p_o", &gaussian::pO<float>, "o"_a, "params"_a, "out"_a = py::none());
+        gaussian.def("p_obs", &gaussian::pObs<double>, "obs"_a, "params"_a, "out"_a = py::none());
+        gaussian.def("p_obs", &gaussian::pObs<float>, "obs"_a, "params"_a, "out"_a = py::none());
     }
 }
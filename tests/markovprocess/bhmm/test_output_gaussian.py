@@ -17,10 +17,13 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import copy
 import unittest
+from unittest import mock
 
 import numpy as np
 
+from sktime.markovprocess.bhmm.output_models import gaussian
 from sktime.markovprocess.bhmm.output_models.gaussian import GaussianOutputModel
 
 
@@ -40,5 +43,238 @@ class TestOutputGaussian(unittest.TestCase):
             p_c = self.G.p_obs(self.obs)
             # TODO: test something useful
 
+    def test_p_obs_values(self):
+        p_o = self.G.p_obs(self.obs)
+        self.assertEqual(p_o.shape, (len(self.obs), self.G.n_states))
+        for i in range(self.G.n_states):
+            mu, sigma = self.G.means[i], self.G.sigmas[i]
+            expected = np.exp(-0.5 * ((self.obs - mu) / sigma) ** 2) / (np.sqrt(2 * np.pi) * sigma)
+            np.testing.assert_allclose(p_o[:, i], expected)
+
+    def test_p_obs_sigmas_update(self):
+        self.G.sigmas = np.array([0.1, 0.3, 1.0])
+        expected = np.exp(-0.5 * ((self.obs[:, None] - self.G.means) / self.G.sigmas) ** 2) \
+            / (np.sqrt(2 * np.pi) * self.G.sigmas)
+        np.testing.assert_allclose(self.G.p_obs(self.obs), expected, atol=1e-200)
+
+    def test_p_obs_buffer(self):
+        G = GaussianOutputModel(3, means=self.G.means, sigmas=self.G.sigmas, cache_p_obs=True)
+        p_o = G.p_obs(self.obs)
+        np.testing.assert_allclose(p_o, self.G.p_obs(self.obs))
+        self.assertIs(G.p_obs(self.obs[::-1]), p_o)
+        np.testing.assert_allclose(p_o, self.G.p_obs(self.obs[::-1]))
+        p_o_short = G.p_obs(self.obs[:10])
+        self.assertIsNot(p_o_short, p_o)
+        G.reset_buffers()
+        self.assertIsNot(G.p_obs(self.obs[:10]), p_o_short)
+        # without caching, every call returns a new array
+        self.assertIsNot(self.G.p_obs(self.obs), self.G.p_obs(self.obs))
+
+    def test_copy_p_obs_buffer(self):
+        G = GaussianOutputModel(3, means=self.G.means, sigmas=self.G.sigmas, cache_p_obs=True)
+        G.p_obs(self.obs)
+        G_copy = copy.deepcopy(G)
+        self.assertIsNone(G_copy._p_obs_buffer)
+        self.assertIsNotNone(G._p_obs_buffer)
+        np.testing.assert_equal(G_copy.p_obs(self.obs), G.p_obs(self.obs))
+
+    def test_p_obs_oversized_out(self):
+        # the estimators pass one (maxT, N) buffer for trajectories of all lengths
+        obs = self.obs[:1234]
+        mu, sigma = self.G.means, self.G.sigmas
+        log_p_o = -0.5 * ((obs[:, None] - mu) / sigma) ** 2 - np.log(np.sqrt(2 * np.pi) * sigma)
+        for method, expected in ((self.G.p_obs, np.exp(log_p_o)), (self.G.log_p_obs, log_p_o)):
+            out = np.full((len(self.obs), self.G.n_states), 7.)
+            self.assertIs(method(obs, out=out), out)
+            np.testing.assert_allclose(out[:len(obs)], expected, atol=1e-200)
+            np.testing.assert_equal(out[len(obs):], 7.)
+
+    def test_p_obs_outliers(self):
+        obs = np.array([0., 1e3, -0.5])
+        p_o = self.G.p_obs(obs)
+        self.assertTrue(self.G.found_outliers)
+        np.testing.assert_equal(p_o[1], 1.)
+        np.testing.assert_allclose(p_o[[0, 2]], self.G.p_obs(obs[[0, 2]]))
+
+    def test_log_p_obs(self):
+        log_p_o = self.G.log_p_obs(self.obs)
+        np.testing.assert_allclose(log_p_o, np.log(self.G.p_obs(self.obs)))
+        # far outliers underflow in p_obs, but not in log_p_obs
+        log_p_o = self.G.log_p_obs(np.array([-1e3, 1e3]))
+        self.assertTrue(np.all(np.isfinite(log_p_o)))
+        mu, sigma = self.G.means, self.G.sigmas
+        np.testing.assert_allclose(log_p_o[0], -0.5 * ((-1e3 - mu) / sigma) ** 2 - np.log(np.sqrt(2 * np.pi) * sigma))
+
+    def test_sub_output_model(self):
+        sub = self.G.sub_output_model([0, 2])
+        self.assertEqual(sub.n_states, 2)
+        np.testing.assert_equal(sub.means, self.G.means[[0, 2]])
+        np.testing.assert_equal(sub.sigmas, self.G.sigmas[[0, 2]])
+        np.testing.assert_allclose(sub.p_obs(self.obs), self.G.p_obs(self.obs)[:, [0, 2]])
+
+    def test_sigmas_read_only(self):
+        with self.assertRaises(ValueError):
+            self.G.sigmas[0] = 1.
+        np.testing.assert_equal(self.G.sigmas, [0.2, 0.2, 0.2])
+        # assignment goes through the setter, which keeps p_obs consistent
+        sigmas = np.array([1., 0.2, 0.2])
+        self.G.sigmas = sigmas
+        expected = np.exp(-0.5 * ((-0.5 - self.G.means) / sigmas) ** 2) / (np.sqrt(2 * np.pi) * sigmas)
+        np.testing.assert_allclose(self.G.p_obs(np.array([-0.5]))[0], expected)
+
+    def test_fit(self):
+        observations = [np.random.randn(1000), np.random.randn(500) + 1.] + [np.random.randn(10) for _ in range(20)]
+        weights = [np.random.dirichlet([2, 3, 4], size=len(o)) for o in observations]
+        self.G.fit(observations, weights)
+
+        X = np.concatenate(observations)
+        W = np.concatenate(weights)
+        for i in range(self.G.n_states):
+            mean = np.average(X, weights=W[:, i])
+            sigma = np.sqrt(np.average((X - mean) ** 2, weights=W[:, i]))
+            np.testing.assert_almost_equal(self.G.means[i], mean)
+            np.testing.assert_almost_equal(self.G.sigmas[i], sigma)
+
+    def test_fit_chunks(self):
+        offsets = np.cumsum([0, 30, 40, 100, 10, 10, 150, 50])
+        self.assertEqual(list(gaussian._chunks(offsets, 100)), [(0, 2), (2, 3), (3, 5), (5, 6), (6, 7)])
+        self.assertEqual(list(gaussian._chunks(offsets[:1], 100)), [])
+
+        observations = [np.random.randn(n) for n in (30, 40, 100, 10, 10, 150, 50)]
+        weights = [np.random.dirichlet([2, 3, 4], size=len(o)) for o in observations]
+        self.G.fit(observations, weights)
+        means, sigmas = self.G.means.copy(), self.G.sigmas.copy()
+        with mock.patch.object(gaussian, '_FIT_CHUNK_LENGTH', 100):
+            self.G.fit(observations, weights)
+        np.testing.assert_allclose(self.G.means, means)
+        np.testing.assert_allclose(self.G.sigmas, sigmas)
+
+    def test_fit_empty(self):
+        means, sigmas = self.G.means.copy(), self.G.sigmas.copy()
+        self.G.fit([], [])
+        np.testing.assert_array_equal(self.G.means, means)
+        np.testing.assert_array_equal(self.G.sigmas, sigmas)
+
+    def test_fit_offset(self):
+        # large offset relative to the spread of the data
+        observations = [1e6 + 1e-3 * np.random.randn(1000)]
+        weights = [np.random.dirichlet([2, 3, 4], size=1000)]
+        self.G.fit(observations, weights)
+        for i in range(self.G.n_states):
+            mean = np.average(observations[0], weights=weights[0][:, i])
+            sigma = np.sqrt(np.average((observations[0] - mean) ** 2, weights=weights[0][:, i]))
+            np.testing.assert_allclose(self.G.means[i], mean)
+            np.testing.assert_allclose(self.G.sigmas[i], sigma, rtol=1e-6)
+
+    def test_fit_small_sigma(self):
+        # the variance floor is relative to the data, so tiny but resolved sigmas are kept
+        for dtype, scale in ((np.float64, 1e-10), (np.float32, 1e-4)):
+            G = GaussianOutputModel(3, dtype=dtype)
+            observations = [scale * np.random.randn(1000)]
+            weights = [np.random.dirichlet([2, 3, 4], size=1000)]
+            G.fit(observations, weights)
+            for i in range(G.n_states):
+                mean = np.average(observations[0], weights=weights[0][:, i])
+                sigma = np.sqrt(np.average((observations[0] - mean) ** 2, weights=weights[0][:, i]))
+                np.testing.assert_allclose(G.sigmas[i], sigma, rtol=1e-5)
+
+    def test_fit_constant(self):
+        observations = [np.full(100, 3.)]
+        weights = [np.random.dirichlet([2, 3, 4], size=100)]
+        self.G.fit(observations, weights)
+        np.testing.assert_allclose(self.G.means, 3.)
+        self.assertTrue(np.all(self.G.sigmas > 0))
+        self.assertTrue(np.all(np.isfinite(self.G.p_obs(observations[0]))))
+
+    def test_generate_observation_trajectory(self):
+        s_t = np.random.randint(0, self.G.n_states, size=30000)
+        o_t = self.G.generate_observation_trajectory(s_t)
+        self.assertEqual(o_t.shape, s_t.shape)
+        self.assertEqual(o_t.dtype, np.float64)
+        for i in range(self.G.n_states):
+            np.testing.assert_allclose(o_t[s_t == i].mean(), self.G.means[i], atol=0.02)
+            np.testing.assert_allclose(o_t[s_t == i].std(), self.G.sigmas[i], atol=0.02)
+
+    def test_generate_observation_trajectories(self):
+        s_ts = [np.random.randint(0, self.G.n_states, size=n) for n in (10000, 0, 20000)]
+        o_ts = self.G.generate_observation_trajectories(s_ts)
+        self.assertEqual([len(o_t) for o_t in o_ts], [len(s_t) for s_t in s_ts])
+        s_t, o_t = np.concatenate(s_ts), np.concatenate(o_ts)
+        for i in range(self.G.n_states):
+            np.testing.assert_allclose(o_t[s_t == i].mean(), self.G.means[i], atol=0.02)
+            np.testing.assert_allclose(o_t[s_t == i].std(), self.G.sigmas[i], atol=0.02)
+        self.assertEqual(self.G.generate_observation_trajectories([]), [])
+
+    def test_seed(self):
+        s_t = np.random.randint(0, self.G.n_states, size=100)
+        o_t = [GaussianOutputModel(3, means=self.G.means, sigmas=self.G.sigmas, seed=42)
+               .generate_observation_trajectory(s_t) for _ in range(2)]
+        np.testing.assert_equal(o_t[0], o_t[1])
+
+    def test_float32(self):
+        G = GaussianOutputModel(3, means=self.G.means, sigmas=self.G.sigmas, dtype=np.float32)
+        self.assertEqual(G.means.dtype, np.float32)
+        # float32 densities underflow much earlier, so stay close to the means
+        obs = np.linspace(-1, 1, 1000)
+        p_o = G.p_obs(obs)
+        self.assertEqual(p_o.dtype, np.float32)
+        np.testing.assert_allclose(p_o, self.G.p_obs(obs), rtol=1e-4)
+        self.assertEqual(G.log_p_obs(obs).dtype, np.float32)
+        # computation in the dtype of a given output array
+        out = np.empty((len(self.obs), 3), dtype=np.float64)
+        self.assertIs(G.p_obs(self.obs, out=out), out)
+        np.testing.assert_allclose(out, self.G.p_obs(self.obs), rtol=1e-4)
+        s_t = np.random.randint(0, G.n_states, size=100)
+        self.assertEqual(G.generate_observation_trajectory(s_t).dtype, np.float32)
+        self.assertEqual(G.sub_output_model([0, 1]).dtype, np.float32)
+
+    def test_global_seed(self):
+        s_t = np.random.randint(0, self.G.n_states, size=100)
+        o_t = []
+        for _ in range(2):
+            np.random.seed(42)
+            o_t.append(self.G.generate_observation_trajectory(s_t))
+        np.testing.assert_equal(o_t[0], o_t[1])
+
+    def test_copy_seeded(self):
+        s_t = np.random.randint(0, self.G.n_states, size=100)
+        G = GaussianOutputModel(3, means=self.G.means, sigmas=self.G.sigmas, seed=42)
+        copies = [copy.deepcopy(G) for _ in range(2)]
+        o_t = [c.generate_observation_trajectory(s_t) for c in copies]
+        self.assertFalse(np.array_equal(o_t[0], o_t[1]))
+        np.testing.assert_equal(copies[0].means, G.means)
+        np.testing.assert_equal(copies[0].sigmas, G.sigmas)
+        # copies of identically seeded models are reproducible
+        G2 = GaussianOutputModel(3, means=self.G.means, sigmas=self.G.sigmas, seed=42)
+        np.testing.assert_equal(copy.deepcopy(G2).generate_observation_trajectory(s_t), o_t[0])
+
+    def test_sub_output_model_seeded(self):
+        s_t = np.random.randint(0, 2, size=100)
+        o_t = [GaussianOutputModel(3, means=self.G.means, sigmas=self.G.sigmas, seed=42).sub_output_model([0, 2])
+               .generate_observation_trajectory(s_t) for _ in range(2)]
+        np.testing.assert_equal(o_t[0], o_t[1])
+        # the global random state is not used
+        np.random.seed(1)
+        x = np.random.rand()
+        np.random.seed(1)
+        GaussianOutputModel(3, means=self.G.means, sigmas=self.G.sigmas, seed=42).sub_output_model([0, 2]) \
+            .generate_observation_trajectory(s_t)
+        self.assertEqual(np.random.rand(), x)
+
+    def test_sample(self):
+        observations = [np.random.randn(20000) * 0.3 + 1., np.random.randn(1) - 1., np.array([])]
+        means, sigmas = self.G.means.copy(), self.G.sigmas.copy()
+        with self.assertWarns(UserWarning):
+            self.G.sample(observations)
+        np.testing.assert_allclose(self.G.means[0], 1., atol=0.05)
+        np.testing.assert_allclose(self.G.sigmas[0], 0.3, atol=0.05)
+        # a single observation only updates the mean, no observations update nothing
+        self.assertNotEqual(self.G.means[1], means[1])
+        self.assertEqual(self.G.sigmas[1], sigmas[1])
+        self.assertEqual(self.G.means[2], means[2])
+        self.assertEqual(self.G.sigmas[2], sigmas[2])
+        np.testing.assert_allclose(self.G.p_obs(self.obs), GaussianOutputModel(
+            self.G.n_states, means=self.G.means, sigmas=self.G.sigmas).p_obs(self.obs))
+
 if __name__ == "__main__":
     unittest.main()